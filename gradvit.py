@@ -7,21 +7,62 @@ Original file is located at
     https://colab.research.google.com/drive/1nMw8YLXRXAsoZcCAJPu_vtAqWwi32wA_
 """
 
+import copy
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torchvision
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader, Subset
+import torchvision.transforms.v2 as transforms_v2
+from torch.utils.data import DataLoader
 import matplotlib.pyplot as plt
+import numpy as np
 import torch.nn.functional as F
 
+# Autotune cuDNN kernels for the fixed input shape and allow TF32 matmuls/convs
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
 """**Define Fixed point Utility functions and Fixed ViT Transformer Model**"""
 
 # Fixed-point utility functions
+def _quantize(tensor, scale):
+    """Round to the 16-bit fixed-point grid; shared by the compiled helpers below.
+
+    Runs in fp32 even under autocast: bf16/fp16 cannot represent the 1/scale
+    grid (or the 2**15 - 1 bound), so only the GEMMs use low precision.
+    """
+    return (tensor.float() * scale).round().clamp(-2**15, 2**15 - 1) / scale
+
+@torch.compile
 def fixed_point_quantize(tensor, scale):
-    """Quantize tensor to fixed-point representation."""
-    return torch.round(tensor * scale).clamp(-2**15, 2**15 - 1) / scale
+    """Quantize tensor to fixed-point representation.
+
+    Kept purely functional with a Python-int ``scale`` so that torch.compile
+    fuses mul/round/clamp/div into a single elementwise kernel.
+    """
+    return _quantize(tensor, scale)
+
+@torch.compile
+def fused_add_quantize(x, y, scale):
+    """Quantize the sum of two tensors in one pass (residual add + quantize)."""
+    return _quantize(x + y, scale)
+
+@torch.compile
+def fused_add_ln_quantize(x, attn_output, weight, bias, scale, eps=1e-5):
+    """Quantize the residual sum ``x + attn_output``, then LayerNorm it, in one pass.
+
+    Returns both the quantized sum (the next residual) and its normalized output.
+    """
+    x = _quantize(x + attn_output, scale)
+    return x, F.layer_norm(x, (x.size(-1),), weight, bias, eps)
+
+@torch.compile
+def fused_relu_quantize(tensor, scale):
+    """Apply ReLU then quantize in one pass."""
+    return _quantize(F.relu(tensor), scale)
 
 class FixedPointMLP(nn.Module):
     """Fixed-point implementation of a feedforward layer."""
@@ -32,8 +73,7 @@ class FixedPointMLP(nn.Module):
         self.scale = scale
 
     def forward(self, x):
-        x = fixed_point_quantize(self.fc1(x), self.scale)
-        x = F.relu(x)
+        x = fused_relu_quantize(self.fc1(x), self.scale)
         x = fixed_point_quantize(self.fc2(x), self.scale)
         return x
 
@@ -49,15 +89,13 @@ class FixedPointAttention(nn.Module):
     def forward(self, x):
         batch_size, seq_len, embed_dim = x.size()
         qkv = fixed_point_quantize(self.qkv(x), self.scale)
-        q, k, v = qkv.chunk(3, dim=-1)
-        q = q.view(batch_size, seq_len, self.num_heads, -1).transpose(1, 2)
-        k = k.view(batch_size, seq_len, self.num_heads, -1).transpose(1, 2)
-        v = v.view(batch_size, seq_len, self.num_heads, -1).transpose(1, 2)
-
-        # Scaled dot-product attention
-        scores = torch.matmul(q, k.transpose(-2, -1)) / (k.size(-1) ** 0.5)
-        scores = fixed_point_quantize(F.softmax(scores, dim=-1), self.scale)
-        context = torch.matmul(scores, v)
+        # (B, N, 3*D) -> (3, B, H, N, D_h) as a single strided view
+        qkv = qkv.view(batch_size, seq_len, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        # Scaled dot-product attention (fused kernel, never materializes the NxN scores)
+        context = F.scaled_dot_product_attention(q, k, v, dropout_p=0.0, is_causal=False)
+        context = fixed_point_quantize(context, self.scale)
         context = context.transpose(1, 2).reshape(batch_size, seq_len, embed_dim)
 
         return fixed_point_quantize(self.out_proj(context), self.scale)
@@ -75,11 +113,11 @@ class FixedPointTransformerEncoderLayer(nn.Module):
     def forward(self, x):
         # Self-attention
         attn_output = fixed_point_quantize(self.self_attn(self.norm1(x)), self.scale)
-        x = fixed_point_quantize(x + attn_output, self.scale)
+        x, h = fused_add_ln_quantize(x, attn_output, self.norm2.weight, self.norm2.bias, self.scale, self.norm2.eps)
 
         # Feedforward
-        mlp_output = fixed_point_quantize(self.mlp(self.norm2(x)), self.scale)
-        x = fixed_point_quantize(x + mlp_output, self.scale)
+        mlp_output = fixed_point_quantize(self.mlp(h), self.scale)
+        x = fused_add_quantize(x, mlp_output, self.scale)
 
         return x
 
@@ -93,13 +131,13 @@ class FixedPointViT(nn.Module):
         self.patch_size = patch_size
         # number of patches
         self.patch_dim = (image_size // patch_size) ** 2
-        self.embedding = nn.Linear(3 * patch_size * patch_size, embed_dim)
+        self.patch_conv = nn.Conv2d(3, embed_dim, kernel_size=patch_size, stride=patch_size, bias=True)
 
         # Positional embeddings
         self.positional_embedding = nn.Parameter(torch.zeros(1, self.patch_dim, embed_dim))
 
         # Transformer encoder
-        self.layers = nn.ModuleList([
+        self.layers = nn.Sequential(*[
             FixedPointTransformerEncoderLayer(embed_dim, num_heads, hidden_dim, scale)
             for _ in range(depth)
         ])
@@ -108,21 +146,15 @@ class FixedPointViT(nn.Module):
         self.classifier = nn.Linear(embed_dim, num_classes)
 
     def forward(self, x):
-        batch_size = x.size(0)
+        # Extract and embed the patches in one strided convolution -> (B, N, embed_dim)
+        x = self.patch_conv(x).flatten(2).transpose(1, 2)
+        x = fixed_point_quantize(x, self.scale)
 
-        # Extract patches and flatten them
-        patches = x.unfold(2, self.patch_size, self.patch_size).unfold(3, self.patch_size, self.patch_size)
-        patches = patches.contiguous().view(batch_size, -1, 3 * self.patch_size * self.patch_size)
-
-        # Embed the patches
-        x = fixed_point_quantize(self.embedding(patches), self.scale)
-
-        # Add positional embeddings
-        x = fixed_point_quantize(x + self.positional_embedding, self.scale)
+        # Add positional embeddings, quantized on the (1, N, D) parameter rather than the (B, N, D) sum
+        x = x + fixed_point_quantize(self.positional_embedding, self.scale)
 
         # Transformer encoder
-        for layer in self.layers:
-            x = layer(x)
+        x = self.layers(x)
 
         # Classification head (global average pooling)
         x = x.mean(dim=1)
@@ -132,6 +164,7 @@ class FixedPointViT(nn.Module):
 
 # Hyperparameters
 batch_size = 64
+eval_batch_size = 512
 epochs = 200
 learning_rate = 0.001
 image_size = 32
@@ -151,38 +184,63 @@ target_classes = [0, 1, 2]  # 'airplane', 'automobile', 'bird'
 #     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))  # Normalize to [-1, 1]
 # ])
 
-transform = transforms.Compose([transforms.RandomCrop(size=32),
-                                              transforms.RandomHorizontalFlip(),
-                                              transforms.ToTensor(),
-                                              transforms.Normalize(mean=[0.4914, 0.4822, 0.4465],
-                                                                  std=[0.2471, 0.2435, 0.2616]),
-                                              ])
-test_transform = transforms.Compose([transforms.ToTensor(),
-                                            transforms.Normalize(mean=[0.4914, 0.4822, 0.4465],
-                                                                  std=[0.2471, 0.2435, 0.2616]),
-                                              ])
-train_set = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform)
-test_set = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=test_transform)
-
-# Filter the dataset to include only classes [0, 1, 2]
-train_indices = [i for i, label in enumerate(train_set.targets) if label in target_classes]
-test_indices = [i for i, label in enumerate(test_set.targets) if label in target_classes]
-
-# Subset the data for training and testing
-train_subset = Subset(train_set, train_indices)
-test_subset = Subset(test_set, test_indices)
-
-train_loader = DataLoader(train_subset, batch_size=batch_size, shuffle=True,pin_memory=True, num_workers=2)
-test_loader = DataLoader(test_subset, batch_size=batch_size, shuffle=False,pin_memory=True, num_workers=2)
+cifar_mean = [0.4914, 0.4822, 0.4465]
+cifar_std = [0.2471, 0.2435, 0.2616]
+
+class NormalizedCIFAR10(torchvision.datasets.CIFAR10):
+    """CIFAR-10 (optionally restricted to ``classes``) with images converted to
+    normalized CHW float tensors once, up front."""
+    def __init__(self, *args, classes=None, mean=cifar_mean, std=cifar_std, **kwargs):
+        super(NormalizedCIFAR10, self).__init__(*args, **kwargs)
+        if classes is not None:
+            # Filter before building the cache so only the selected classes are normalized
+            mask = torch.isin(torch.as_tensor(self.targets), torch.tensor(classes))
+            indices = mask.nonzero(as_tuple=True)[0]
+            self.data = self.data[indices.numpy()]
+            self.targets = [self.targets[i] for i in indices.tolist()]
+        mean = torch.tensor(mean)
+        std = torch.tensor(std)
+        self.data_tensor = ((torch.from_numpy(self.data).float() / 255. - mean[None, None, None]) / std[None, None, None]).permute(0, 3, 1, 2).contiguous()
+
+    def __getitem__(self, index):
+        img, target = self.data_tensor[index], self.targets[index]
+        # Only the random augmentations remain per sample
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+transform = transforms_v2.Compose([transforms_v2.RandomCrop(size=32),
+                                   transforms_v2.RandomHorizontalFlip(),
+                                   ])
+# Only classes [0, 1, 2] are kept
+train_set = NormalizedCIFAR10(root='./data', train=True, download=True, transform=transform, classes=target_classes)
+test_set = NormalizedCIFAR10(root='./data', train=False, download=True, classes=target_classes)
+
+# Keep workers alive across epochs and prefetch ahead so the input pipeline keeps up with the GPU
+num_workers = max(2, (os.cpu_count() or 2) // 2)
+train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, pin_memory=True, num_workers=num_workers,
+                          persistent_workers=True, prefetch_factor=4, drop_last=True)
+test_loader = DataLoader(test_set, batch_size=eval_batch_size, shuffle=False, pin_memory=True, num_workers=num_workers,
+                         persistent_workers=True, prefetch_factor=4)
 
 """**Model Initialization**"""
 
 # Define the model
-model = FixedPointViT(image_size, patch_size, len(target_classes), embed_dim, depth, num_heads, hidden_dim, scale).cuda()
+# base_model is the plain module (growth, checkpoints, export); model is its compiled wrapper
+base_model = FixedPointViT(image_size, patch_size, len(target_classes), embed_dim, depth, num_heads, hidden_dim, scale).cuda()
+base_model = base_model.to(memory_format=torch.channels_last)
+model = torch.compile(base_model, mode="reduce-overhead", fullgraph=False)
 
 # Loss and optimizer
 criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+optimizer = optim.Adam(model.parameters(), lr=learning_rate, fused=True)
+
+# Mixed precision: bf16 only on GPUs with native bf16 tensor cores (Ampere+),
+# otherwise fp16 (e.g. the Colab T4) with a GradScaler to avoid gradient underflow
+amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+scaler = torch.amp.GradScaler('cuda', enabled=(amp_dtype == torch.float16))
 
 # Lists to store accuracy, loss,average gradient norms and growth epochs for plotting
 train_losses = []
@@ -198,14 +256,33 @@ grad_threshold = 0.3
 loss_threshold = 0.95
 grow_every_n_epochs = 20
 
-#Scheduler
-scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-    optimizer,
-    mode='min',
-    factor=0.5,
-    patience=5,
-    min_lr=0.001
-)
+#Scheduler (stepped once per epoch, independent of the training loss)
+scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
+
+# Growth step, shared by training and checkpoint resume so both build the same model/optimizer layout
+def grow_model(base_model, optimizer, scheduler):
+    """Append a new encoder layer, register it with the optimizer and scheduler, and return the recompiled model."""
+    new_layer = FixedPointTransformerEncoderLayer(embed_dim, num_heads, hidden_dim, scale)
+
+    # Move the new layer to the correct device #added to maintain on same device
+    new_layer = new_layer.to(next(base_model.parameters()).device)
+
+    # Initialize new layer with smaller weights
+    for param in new_layer.parameters():
+            nn.init.normal_(param, mean=0.0, std=0.02)
+
+    # Append the new layer to the model
+    base_model.layers = nn.Sequential(*list(base_model.layers), new_layer)
+
+    # Register only the new layer with the optimizer (L2 regularization via weight decay),
+    # keeping the Adam moments of the existing layers; it joins the schedule at the current LR
+    optimizer.add_param_group({'params': new_layer.parameters(), 'lr': optimizer.param_groups[0]['lr'], 'weight_decay': 1e-4})
+    scheduler.base_lrs.append(learning_rate)
+
+    # Retrace the grown graph; reset Dynamo first so stale per-depth graphs don't exhaust
+    # the recompile limit and silently fall back to eager
+    torch._dynamo.reset()
+    return torch.compile(base_model, mode="reduce-overhead", fullgraph=False)
 
 from google.colab import drive
 drive.mount('/content/drive')
@@ -215,7 +292,15 @@ load_model = 0
 
 if (load_model == 1):
   checkpoint = torch.load('/content/drive/My Drive/ECE498NSG/models/GRADViT.pt')
-  model.load_state_dict(checkpoint['model_state_dict'])
+  # Checkpoints from the unfold + Linear patch embedding can't be mapped onto patch_conv: the old
+  # unfold().view() mixed channel and patch-position values, so its weights have no per-patch meaning
+  if 'embedding.weight' in checkpoint['model_state_dict']:
+    raise RuntimeError("Checkpoint uses the old unfold + Linear patch embedding; retrain with patch_conv")
+  # Replay the growth first so the layers.<i>.* keys, optimizer param groups and
+  # scheduler base_lrs all match the checkpoint
+  for _ in range(checkpoint['depth'] - len(base_model.layers)):
+    model = grow_model(base_model, optimizer, scheduler)
+  base_model.load_state_dict(checkpoint['model_state_dict'])
   optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
   scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
   train_losses = checkpoint['train_losses']
@@ -229,47 +314,49 @@ if (load_model == 1):
 # Training loop
 def train(model, train_loader, criterion, optimizer, epoch):
     model.train()
-    running_loss = 0.0
-    correct = 0
+    # Statistics are accumulated on the device and synced once per epoch
+    running_loss = torch.zeros((), device='cuda')
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
     total = 0
     gradient_norms = []
 
     for batch_idx, (inputs, labels) in enumerate(train_loader):
-        inputs, labels = inputs.cuda(), labels.cuda()
+        inputs, labels = inputs.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+        inputs = inputs.to(memory_format=torch.channels_last)
 
         # Zero the parameter gradients
-        optimizer.zero_grad()
-
-        # Forward pass
-        outputs = model(inputs)
-
-        # Compute loss
-        loss = criterion(outputs, labels)
-        loss.backward()
+        optimizer.zero_grad(set_to_none=True)
 
-        # Calculate gradient norm
-        grad_norm = torch.norm(torch.cat([p.grad.view(-1) for p in model.parameters() if p.grad is not None]))
-        gradient_norms.append(grad_norm.item())
+        # Forward pass and loss under autocast (the scaler is a no-op for bf16)
+        with torch.autocast(device_type='cuda', dtype=amp_dtype):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
 
-        # Gradient clipping (if needed)
-        if grad_norm > grad_clip_threshold:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_threshold)
+        # Gradient clipping (no-op below the threshold); returns the pre-clip gradient norm,
+        # reduced with a single fused _foreach_norm over all gradients
+        grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_threshold, foreach=True)
+        gradient_norms.append(grad_norm.detach())
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Track statistics
-        running_loss += loss.item()
+        running_loss += loss.detach()
         _, predicted = torch.max(outputs, 1)
-        correct += (predicted == labels).sum().item()
+        correct += (predicted == labels).sum()
         total += labels.size(0)
 
-    epoch_loss = running_loss / len(train_loader)
-    epoch_accuracy = 100 * correct / total
+    epoch_loss = (running_loss / len(train_loader)).item()
+    epoch_accuracy = 100 * correct.item() / total
     train_losses.append(epoch_loss)
     train_accuracies.append(epoch_accuracy)
 
     # Track average gradient norm for the epoch
-    avg_grad_norm = sum(gradient_norms) / len(gradient_norms)
+    # (fp16 overflow steps report an inf norm and are skipped by the scaler, so leave them out)
+    gradient_norms = torch.stack(gradient_norms)
+    avg_grad_norm = gradient_norms[gradient_norms.isfinite()].mean().item()
     avg_grad_norms.append(avg_grad_norm)
 
     # Check if the model should grow -> Growth Criterias
@@ -277,22 +364,11 @@ def train(model, train_loader, criterion, optimizer, epoch):
         print(f"Model growth triggered at epoch {epoch + 1}")
         growth_epochs.append(epoch + 1)
         # Grow the model
-        new_layer = FixedPointTransformerEncoderLayer(embed_dim, num_heads, hidden_dim, scale)
-
-        # Move the new layer to the correct device #added to maintain on same device
-        new_layer = new_layer.to(next(model.parameters()).device)
-
-        # Initialize new layer with smaller weights
-        for param in new_layer.parameters():
-                nn.init.normal_(param, mean=0.0, std=0.02)
+        model = grow_model(base_model, optimizer, scheduler)
 
-        # Append the new layer to the model
-        model.layers.append(new_layer)
-
-        # Apply weight decay to the optimizer (L2 regularization)
-        optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-4)
-        scheduler.step(epoch_loss)
+    scheduler.step()
     print(f"Epoch [{epoch+1}/{epochs}], Training_Loss: {epoch_loss:.4f}, Training_Accuracy: {epoch_accuracy:.2f}%")
+    return model
 
 # Validation loop
 # def validate(model, test_loader):
@@ -316,9 +392,10 @@ def validate(model, test_loader, criterion):
     correct = 0
     total = 0
     running_loss = 0.0
-    with torch.no_grad():
+    with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=amp_dtype):
         for inputs, labels in test_loader:
-            inputs, labels = inputs.cuda(), labels.cuda()
+            inputs, labels = inputs.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+            inputs = inputs.to(memory_format=torch.channels_last)
             outputs = model(inputs)
             _, predicted = torch.max(outputs, 1)
 
@@ -342,11 +419,11 @@ def validate(model, test_loader, criterion):
 
 # Training and validation loop
 for epoch in range(epochs):
-    train(model, train_loader, criterion, optimizer, epoch)
+    model = train(model, train_loader, criterion, optimizer, epoch)
     validate(model, test_loader, criterion)
 
 torch.save({
-    'model_state_dict': model.state_dict(),
+    'model_state_dict': base_model.state_dict(),
     'optimizer_state_dict': optimizer.state_dict(),
     'scheduler_state_dict': scheduler.state_dict(),
     'train_losses': train_losses,
@@ -354,8 +431,36 @@ torch.save({
     'val_accuracies': val_accuracies,
     'growth_epochs': growth_epochs,
     'avg_grad_norms': avg_grad_norms,
+    'depth': len(base_model.layers),  # grown depth, read by the load_model path
 }, save_path)
 
+"""**Int8 Inference Model**"""
+
+# Swap the fake-quantized nn.Linear layers for real int8 GEMMs for deployment
+int8_model = torch.ao.quantization.quantize_dynamic(
+    copy.deepcopy(base_model).cpu().eval(), {nn.Linear}, dtype=torch.qint8
+)
+
+# Check the int8 model keeps the float model's accuracy on the test set (CPU only).
+# Its forward still calls the @torch.compile fixed-point helpers, so this needs a working
+# Inductor C++ toolchain on the host.
+int8_correct = 0
+int8_total = 0
+with torch.inference_mode():
+    for inputs, labels in test_loader:
+        outputs = int8_model(inputs.to(memory_format=torch.channels_last))
+        _, predicted = torch.max(outputs, 1)
+        int8_correct += (predicted == labels).sum().item()
+        int8_total += labels.size(0)
+int8_accuracy = 100 * int8_correct / int8_total
+print(f"Validation_Accuracy: float {val_accuracies[-1]:.2f}%, int8 {int8_accuracy:.2f}%")
+
+torch.save({
+    'model_state_dict': int8_model.state_dict(),
+    'depth': len(int8_model.layers),
+    'val_accuracy': int8_accuracy,
+}, save_path.replace('.pt', '_int8.pt'))
+
 """**Plot Matrics -> Training Loss, Training Accuracy, Validation accuracy, Gradient Norms for each epoch**"""
 
 plt.figure(figsize=(16, 6))
@@ -403,12 +508,9 @@ plt.show()
 
 # Function to smooth the gradient norms using a simple moving average
 def smooth(data, window_size=5):
-    smoothed = []
-    for i in range(len(data)):
-        start = max(0, i - window_size + 1)
-        end = i + 1
-        smoothed.append(sum(data[start:end]) / (end - start))
-    return smoothed
+    # Trailing moving average; the first window_size - 1 points average over what is available
+    sums = np.convolve(data, np.ones(window_size), mode='full')[:len(data)]
+    return sums / np.minimum(np.arange(1, len(data) + 1), window_size)
 
 # Apply smoothing to avg_grad_norms
 smoothed_grad_norms = smooth(avg_grad_norms, window_size=5)
@@ -460,12 +562,9 @@ plt.show()
 
 # Function to smooth the gradient norms using a simple moving average
 def smooth(data, window_size=5):
-    smoothed = []
-    for i in range(len(data)):
-        start = max(0, i - window_size + 1)
-        end = i + 1
-        smoothed.append(sum(data[start:end]) / (end - start))
-    return smoothed
+    # Trailing moving average; the first window_size - 1 points average over what is available
+    sums = np.convolve(data, np.ones(window_size), mode='full')[:len(data)]
+    return sums / np.minimum(np.arange(1, len(data) + 1), window_size)
 
 # Apply smoothing to avg_grad_norms
 smoothed_grad_norms = smooth(avg_grad_norms, window_size=5)